@@ -1,18 +1,21 @@
+import datetime
 import logging
 import os
-import signal
-import sys
-import time
-from os import path
-from socket import gethostname
-from urllib.parse import urlparse
+import tempfile
+import threading
+from contextlib import contextmanager
+from importlib.util import find_spec
 
 import click
-from OpenSSL import crypto
 
-from ..server import create_app, init_app, setup_debug_logging
+from ..server import (
+    create_app,
+    init_app,
+    init_app_hwibridge,
+    setup_debug_logging,
+    setup_filelog,
+)
 from ..specter_error import SpecterError
-from ..util.tor import start_hidden_service, stop_hidden_services
 
 logger = logging.getLogger(__name__)
 
@@ -118,6 +121,7 @@ def server(
 
     if port:
         app.config["PORT"] = int(port)
+    port = app.config["PORT"]
 
     # devstatus_threshold
     if devstatus_threshold is not None:
@@ -135,43 +139,40 @@ def server(
     if host != app.config["HOST"]:
         app.config["HOST"] = host
 
+    ssl_context = configure_ssl(app.config, ssl)
+
     # set up kwargs dict for app.run
     kwargs = {
         "host": host,
-        "port": app.config["PORT"],
+        "port": port,
+        # watch templates folder to reload when something changes
+        # Only the stat reloader restarts on template edits (see below). The watchdog
+        # reloader ignores directories here and only matches *.py, *.pyc and *.zip,
+        # there template edits are picked up by Jinja's auto_reload (on in debug).
+        "extra_files": ["templates"],
+        **({"ssl_context": ssl_context} if ssl_context is not None else {}),
     }
-    # watch templates folder to reload when something changes
-    extra_dirs = ["templates"]
-    extra_files = extra_dirs[:]
-    for extra_dir in extra_dirs:
-        for dirname, dirs, files in os.walk(extra_dir):
-            for filename in files:
-                filename = os.path.join(dirname, filename)
-                if os.path.isfile(filename):
-                    extra_files.append(filename)
-    kwargs["extra_files"] = extra_files
-
-    kwargs = configure_ssl(kwargs, app.config, ssl)
-
-    app.app_context().push()
+
     if enforcehwiinitialisation:
         app.config["ENFORCE_HWI_INITIALISATION_AT_STARTUP"] = True
-    init_app(app, hwibridge=hwibridge)
-
-    if filelog:
-        # again logging: Creating a logfile in SPECTER_DATA_FOLDER (which needs to exist)
-        app.config["SPECTER_LOGFILE"] = os.path.join(
-            app.specter.data_folder, "specter.log"
-        )
-        fh = logging.FileHandler(app.config["SPECTER_LOGFILE"])
-        formatter = logging.Formatter(app.config["SPECTER_LOGFORMAT"])
-        fh.setFormatter(formatter)
-        logging.getLogger().addHandler(fh)
+    # Only for the initialisation, so it doesn't stay pushed for the process lifetime
+    with app.app_context():
+        if hwibridge:
+            init_app_hwibridge(app)
+        else:
+            init_app(app)
 
-    toraddr_file = path.join(app.specter.data_folder, "onion.txt")
+        if filelog:
+            # again logging: Creating a logfile in SPECTER_DATA_FOLDER (which needs to exist)
+            app.config["SPECTER_LOGFILE"] = os.path.join(
+                app.specter.data_folder, "specter.log"
+            )
+            setup_filelog(
+                app.config["SPECTER_LOGFILE"], app.config["SPECTER_LOGFORMAT"]
+            )
 
     if hwibridge:
-        if kwargs.get("ssl_context"):
+        if ssl_context is not None:
             logger.error(
                 "Running the hwibridge is not supported via SSL. Remove --ssl, --cert, and --key options."
             )
@@ -179,51 +180,100 @@ def server(
         print(
             " * Running in HWI Bridge mode.\n"
             " * You can configure access to the API "
-            "at: %s://%s:%d/hwi/settings" % ("http", host, app.config["PORT"])
+            "at: %s://%s:%d/hwi/settings" % ("http", host, port)
         )
 
     # debug is false by default
     def run(debug=debug):
         try:
             # if we have certificates
-            if "ssl_context" in kwargs:
+            if ssl_context is not None:
                 tor_port = 443
             else:
                 tor_port = 80
-            app.port = kwargs["port"]
+            app.port = port
             app.tor_port = tor_port
-            app.save_tor_address_to = toraddr_file
+            # Needed even if Tor is off now, as it can be switched on via the settings
+            app.save_tor_address_to = os.path.join(app.specter.data_folder, "onion.txt")
             if debug and (tor or os.getenv("CONNECT_TOR") == "True"):
                 print(
                     " * Warning: Cannot use Tor in debug mode. \
                       Starting in production mode instead."
                 )
                 debug = False
+            tor_thread = None
             if (
                 tor
                 or os.getenv("CONNECT_TOR") == "True"
                 or app.specter.config["tor_status"] == True
             ):
-                try:
-                    app.tor_enabled = True
-                    start_hidden_service(app)
-                    if app.specter.config["tor_status"] == False:
-                        app.specter.toggle_tor_status()
-                except Exception as e:
-                    logger.error(f" * Failed to start Tor hidden service: {e}")
-                    logger.error(" * Continuing process with Tor disabled")
-                    logger.exception(e)
-                    app.tor_service_id = None
-                    app.tor_enabled = False
+                from ..util.tor import start_hidden_service
+
+                def start_tor():
+                    # e.g. the storage_callback of toggle_tor_status needs the context
+                    with app.app_context():
+                        try:
+                            # sets app.tor_enabled once the service is up
+                            start_hidden_service(app)
+                            if app.specter.config["tor_status"] == False:
+                                app.specter.toggle_tor_status()
+                        except Exception as e:
+                            logger.error(f" * Failed to start Tor hidden service: {e}")
+                            logger.error(" * Continuing process with Tor disabled")
+                            logger.exception(e)
+                            app.tor_service_id = None
+                            app.tor_enabled = False
+                        finally:
+                            app.tor_ready.set()
+
+                # The settings won't toggle the hidden service until we're done
+                app.tor_ready.clear()
+                tor_thread = threading.Thread(target=start_tor, daemon=True)
             else:
                 app.tor_service_id = None
                 app.tor_enabled = False
+            if debug:
+                if find_spec("watchdog") is not None:
+                    # inotify/FSEvents/kqueue instead of stat-polling every file each second
+                    kwargs["reloader_type"] = "watchdog"
+                else:
+                    # The stat reloader can't watch directories, only files
+                    logger.warning(
+                        "watchdog not installed, falling back to stat reloader"
+                    )
+                    kwargs["extra_files"] = kwargs["extra_files"] + [
+                        filename
+                        for extra_dir in kwargs["extra_files"]
+                        for filename in iter_files(extra_dir)
+                    ]
+            if tor_thread is not None:
+                # Publishing the hidden service might take a while, so we don't let
+                # it delay the listener. The service attaches as soon as it's up.
+                tor_thread.start()
             app.run(debug=debug, **kwargs)
+            # Tor might also have been switched on via the settings in the meantime
+            from ..util.tor import stop_hidden_services
+
             stop_hidden_services(app)
         finally:
             try:
-                if app.specter.tor_controller is not None:
-                    app.specter.tor_controller.close()
+                tor_controller = app.specter.tor_controller
+                if tor_controller is not None:
+
+                    def close_tor_controller():
+                        # exceptions in threads would otherwise bypass the logger
+                        try:
+                            tor_controller.close()
+                        except Exception as e:
+                            logger.error(f"Could not close the tor-controller: {e}")
+                            logger.exception(e)
+
+                    # A hanging control-socket must not block the shutdown
+                    closer = threading.Thread(target=close_tor_controller, daemon=True)
+                    closer.start()
+                    closer.join(timeout=2)
+                    if closer.is_alive():
+                        logger.warning("Closing the tor-controller timed out")
             except SpecterError as se:
                 # no reason to break startup here
                 logger.error("Could not initialize tor-system")
@@ -234,46 +284,155 @@ def server(
     run(debug=debug)
 
 
-def configure_ssl(kwargs, app_config, ssl):
-    """accepts kwargs and adjust them based on the config and ssl"""
+def iter_files(root):
+    """Recursively yields the paths of all files below root. Uses os.scandir as the
+    DirEntry objects already carry the file-type, so no extra stat-call per file
+    """
+    if not os.path.isdir(root):
+        return
+    for entry in os.scandir(root):
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_files(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            yield entry.path
+
+
+def configure_ssl(app_config, ssl):
+    """returns the ssl_context for app.run based on the config and ssl
+    or None if SSL shouldn't be used
+    """
+    cert_path = app_config["CERT"]
+    # The common case: No SSL at all. An empty CERT (e.g. from the env) counts as unset
+    if not ssl and not cert_path:
+        return None
+    key_path = app_config["KEY"]
+
     # If we should create a cert but it's not specified where, let's specify the location
+    # CERT and KEY exist in the config (as None), so setdefault wouldn't help here
+    data_folder = app_config["SPECTER_DATA_FOLDER"]
+    if not cert_path or not key_path:
+        if not cert_path:
+            cert_path = os.path.join(data_folder, "cert.pem")
+            app_config["CERT"] = cert_path
+        if not key_path:
+            key_path = os.path.join(data_folder, "key.pem")
+            app_config["KEY"] = key_path
 
-    if not ssl and app_config["CERT"] is None:
-        return kwargs
-
-    if app_config["CERT"] is None:
-        app_config["CERT"] = app_config["SPECTER_DATA_FOLDER"] + "/cert.pem"
-    if app_config["KEY"] is None:
-        app_config["KEY"] = app_config["SPECTER_DATA_FOLDER"] + "/key.pem"
-
-    if not os.path.exists(app_config["CERT"]):
-        logger.info("Creating SSL-cert " + app_config["CERT"])
-        # create a key pair
-        k = crypto.PKey()
-        k.generate_key(crypto.TYPE_RSA, 2048)
-
-        # create a self-signed cert
-        cert = crypto.X509()
-        cert.get_subject().C = app_config["SPECTER_SSL_CERT_SUBJECT_C"]
-        cert.get_subject().ST = app_config["SPECTER_SSL_CERT_SUBJECT_ST"]
-        cert.get_subject().L = app_config["SPECTER_SSL_CERT_SUBJECT_L"]
-        cert.get_subject().O = app_config["SPECTER_SSL_CERT_SUBJECT_O"]
-        cert.get_subject().OU = app_config["SPECTER_SSL_CERT_SUBJECT_OU"]
-        cert.get_subject().CN = app_config["SPECTER_SSL_CERT_SUBJECT_CN"]
-        cert.set_serial_number(app_config["SPECTER_SSL_CERT_SERIAL_NUMBER"])
-        cert.gmtime_adj_notBefore(0)
-        cert.gmtime_adj_notAfter(10 * 365 * 24 * 60 * 60)
-        cert.set_issuer(cert.get_subject())
-        cert.set_pubkey(k)
-        cert.sign(k, "sha1")
-
-        open(app_config["CERT"], "wt").write(
-            crypto.dump_certificate(crypto.FILETYPE_PEM, cert).decode("utf-8")
-        )
-        open(app_config["KEY"], "wt").write(
-            crypto.dump_privatekey(crypto.FILETYPE_PEM, k).decode("utf-8")
+    if not os.path.exists(cert_path):
+        # Parallel startups would otherwise both generate (and overwrite) the pair.
+        # The lockfile lives in the data folder, not next to a user-supplied --cert
+        lock_folder = os.path.expanduser(data_folder)
+        os.makedirs(lock_folder, exist_ok=True)
+        with exclusive_lock(os.path.join(lock_folder, "ssl-cert.lock")):
+            # another process might have created it while we were waiting
+            if not os.path.exists(cert_path):
+                create_self_signed_cert(app_config)
+
+    logger.info("Configuring SSL-certificate " + cert_path)
+    return (cert_path, key_path)
+
+
+def create_self_signed_cert(app_config):
+    """Creates a key pair and a self-signed cert and stores them at KEY and CERT"""
+    # only load cryptography if we really need to create a cert
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    cert_path = app_config["CERT"]
+    key_path = app_config["KEY"]
+    logger.info("Creating SSL-cert " + cert_path)
+    # create a key pair
+    # P-256 instead of RSA as it's generated in no time. Ed25519 would be even faster
+    # but browsers don't accept it for TLS-certificates (yet).
+    k = ec.generate_private_key(ec.SECP256R1())
+
+    # create a self-signed cert
+    subject = x509.Name(
+        [
+            x509.NameAttribute(
+                NameOID.COUNTRY_NAME, app_config["SPECTER_SSL_CERT_SUBJECT_C"]
+            ),
+            x509.NameAttribute(
+                NameOID.STATE_OR_PROVINCE_NAME,
+                app_config["SPECTER_SSL_CERT_SUBJECT_ST"],
+            ),
+            x509.NameAttribute(
+                NameOID.LOCALITY_NAME, app_config["SPECTER_SSL_CERT_SUBJECT_L"]
+            ),
+            x509.NameAttribute(
+                NameOID.ORGANIZATION_NAME, app_config["SPECTER_SSL_CERT_SUBJECT_O"]
+            ),
+            x509.NameAttribute(
+                NameOID.ORGANIZATIONAL_UNIT_NAME,
+                app_config["SPECTER_SSL_CERT_SUBJECT_OU"],
+            ),
+            x509.NameAttribute(
+                NameOID.COMMON_NAME, app_config["SPECTER_SSL_CERT_SUBJECT_CN"]
+            ),
+        ]
+    )
+    now = datetime.datetime.utcnow()
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(subject)
+        .issuer_name(subject)
+        .public_key(k.public_key())
+        .serial_number(
+            app_config["SPECTER_SSL_CERT_SERIAL_NUMBER"] or x509.random_serial_number()
         )
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=10 * 365))
+        .sign(k, hashes.SHA256())
+    )
+
+    # The key first: The existence of the cert is what marks the pair as complete
+    write_atomically(
+        key_path,
+        k.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ).decode("utf-8"),
+    )
+    write_atomically(
+        cert_path,
+        cert.public_bytes(serialization.Encoding.PEM).decode("utf-8"),
+    )
 
-    logger.info("Configuring SSL-certificate " + app_config["CERT"])
-    kwargs["ssl_context"] = (app_config["CERT"], app_config["KEY"])
-    return kwargs
+
+def write_atomically(filename, content):
+    """Writes content to a temporary file next to filename and then moves it in place,
+    so filename either doesn't exist or is complete (also after a crash).
+    """
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wt") as f:
+            f.write(content)
+            # make sure the content is on disk before the file shows up
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+@contextmanager
+def exclusive_lock(lockfile):
+    """Holds an exclusive inter-process lock on lockfile while in the with-block.
+    fcntl isn't available on Windows, there this is a no-op.
+    The lockfile is left in place: unlinking it would let a waiter lock the removed
+    file while a newcomer locks a fresh one.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(lockfile, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
@@ -2,7 +2,6 @@
 import configparser
 import datetime
 import os
-import random
 import secrets
 from pathlib import Path
 
@@ -123,9 +122,12 @@ class BaseConfig(object):
     SPECTER_SSL_CERT_SUBJECT_CN = os.getenv(
         "SPECTER_SSL_CERT_SUBJECT_CN", "Specter Citadel Cert"
     )
-    # For self-signed certs, serial-number collision is a risk, so let's do a random one by default
-    SPECTER_SSL_CERT_SERIAL_NUMBER = int(
-        os.getenv("SPECTER_SSL_CERT_SERIAL_NUMBER", random.randrange(1, 100000))
+    # For self-signed certs, serial-number collision is a risk, so if None (the default),
+    # a random one (x509.random_serial_number) is used
+    SPECTER_SSL_CERT_SERIAL_NUMBER = (
+        int(os.getenv("SPECTER_SSL_CERT_SERIAL_NUMBER"))
+        if os.getenv("SPECTER_SSL_CERT_SERIAL_NUMBER")
+        else None
     )
     INTERNAL_BITCOIND_VERSION = os.getenv("INTERNAL_BITCOIND_VERSION", "0.21.1")
 
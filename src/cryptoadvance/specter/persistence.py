@@ -271,9 +271,12 @@ def storage_callback(mode="write", path=None):
     # First, call extensions which want to get informed.
     # This is working synchronously!
     try:
-        app.specter.service_manager.execute_ext_callbacks(
-            specter_persistence_callback, path=path, mode=mode
-        )
+        # no extensions (and therefore no service_manager) in hwibridge-mode
+        service_manager = getattr(app.specter, "service_manager", None)
+        if service_manager is not None:
+            service_manager.execute_ext_callbacks(
+                specter_persistence_callback, path=path, mode=mode
+            )
     except AttributeError as e:
         # chicken-egg poroblem:
         if str(e).endswith("object has no attribute 'specter'"):
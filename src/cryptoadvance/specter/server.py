@@ -1,8 +1,12 @@
+import atexit
 import logging
 import os
+import queue
 import sys
+import threading
 from distutils.core import setup
 from http.client import HTTPConnection
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 
 from cryptoadvance.specter.liquid.rpc import LiquidRPC
@@ -109,6 +113,9 @@ def create_app(config=None):
     )
     app.tor_service_id = None
     app.tor_enabled = False
+    # cleared while the hidden service is started in the background (see cli_server)
+    app.tor_ready = threading.Event()
+    app.tor_ready.set()
     app.jinja_env.autoescape = select_autoescape(default_for_string=True, default=True)
     logger.info(f"Configuration: {config}")
     app.config.from_object(config)
@@ -133,21 +140,145 @@ def init_app(app: SpecterFlask, hwibridge=False, specter=None):
     app, registers blueprints for extensions, and sets up a context processor and
     language selector for Babel integration. It also initializes a background scheduler
     and runs an after_serverpy_init_app callback.
+    With hwibridge=True, it delegates to the slimmed down init_app_hwibridge.
     """
+    if hwibridge:
+        return init_app_hwibridge(app, specter=specter)
 
     # Configuring a prefix for the app
-    if app.config["APP_URL_PREFIX"] != "":
-        # https://dlukes.github.io/flask-wsgi-url-prefix.html
-        app.wsgi_app = DispatcherMiddleware(
-            Response("Not Found", status=404),
-            {app.config["APP_URL_PREFIX"]: app.wsgi_app},
+    init_url_prefix(app)
+    # Migrations, RPC-timeouts and the (not yet initialized) Specter instance
+    specter = init_specter(app, specter=specter)
+
+    # ServiceManager will instantiate and register blueprints for extensions
+    # It's an attribute to the specter but specter is not aware of it.
+    # However some managers are aware of it and so we need to split
+    # instantiation from initializing and in between attach the service_manager
+    specter.service_manager = ExtensionManager(
+        specter=specter, devstatus_threshold=app.config["SERVICES_DEVSTATUS_THRESHOLD"]
+    )
+
+    def service_manager_cleanup_on_exit(signum, frame):
+        return specter.service_manager.execute_ext_callbacks(
+            callbacks.cleanup_on_exit, signum, frame
         )
+
+    specter.call_functions_at_cleanup_on_exit.append(service_manager_cleanup_on_exit)
+
+    specter.initialize()
+
+    # HWI
+    specter.hwi = HWIBridge(app.config["ENFORCE_HWI_INITIALISATION_AT_STARTUP"])
+
+    # Login via Flask-Login
+    app.logger.info("Initializing LoginManager")
+    init_login(app, specter)
+    # Attach specter instance so child views (e.g. hwi) can access it
+    app.specter = specter
+    # Executing callback specter_added_to_flask_app
+    app.logger.info("Executing callback specter_added_to_flask_app ...")
+    specter.service_manager.execute_ext_callbacks(specter_added_to_flask_app)
+    if specter.config["auth"].get("method") == "none":
+        app.logger.info("Login disabled")
+        app.config["LOGIN_DISABLED"] = True
+    else:
+        app.logger.info("Login enabled")
+        app.config["LOGIN_DISABLED"] = False
+    app.logger.info("Initializing Controller ...")
+    app.register_blueprint(hwi_server, url_prefix="/hwi")
+    csrf.exempt(hwi_server)
+    with app.app_context():
+        from cryptoadvance.specter.server_endpoints import controller
+        from cryptoadvance.specter.services import controller as serviceController
+
+        # this number of view_functions needs to be updated by hand when some are added or removed.
+        number_of_expected_view_functions = 105
+        if app.config.get("TESTING"):
+            logger.info(
+                f"We have {len(app.view_functions)} view Functions. "
+                f"There should be {number_of_expected_view_functions}."
+            )
+        if (
+            app.config.get("TESTING")
+            and len(app.view_functions) < number_of_expected_view_functions
+        ):
+            # Need to force a reload as otherwise the import is skipped
+            # in pytest, the app is created anew for each test
+            # But we shouldn't do that if not necessary as this would result in
+            # --> View function mapping is overwriting an existing endpoint function
+            # see archblog for more about this nasty workaround
+            import importlib
+
+            logger.info("Reloading controllers")
+            importlib.reload(controller)
+            importlib.reload(serviceController)
+
+    if app.config["SPECTER_API_ACTIVE"]:
+        app.logger.info("Initializing REST ...")
+        from cryptoadvance.specter.api import api_bp
+
+        app.register_blueprint(api_bp)
+
+    init_tor_context_processor(app)
+
+    init_babel(app)
+
+    # Background Scheduler
+    def every5seconds():
+        ctx = app.app_context()
+        ctx.push()
+        app.specter.service_manager.execute_ext_callbacks(callbacks.every5seconds)
+        ctx.pop()
+
+    # initialize scheduler
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    scheduler = APScheduler()
+
+    scheduler.init_app(app)
+    scheduler.start()
+    specter.service_manager.add_required_services_to_users(specter.user_manager.users)
+    logger.info("----> starting service callback_after_serverpy_init_app ")
+    specter.service_manager.execute_ext_callbacks(
+        after_serverpy_init_app, scheduler=scheduler
+    )
+    return app
+
+
+def init_app_hwibridge(app: SpecterFlask, specter=None):
+    """A slimmed down init_app for the --hwibridge mode. It only sets up what the
+    hwi_server blueprint needs (Specter, HWIBridge, login, Babel) and skips the
+    extensions, the controllers, the REST-API and the background scheduler.
+    """
+    init_url_prefix(app)
+    specter = init_specter(app, specter=specter)
+    specter.initialize()
+    specter.hwi = HWIBridge(app.config["ENFORCE_HWI_INITIALISATION_AT_STARTUP"])
+
+    init_login(app, specter)
+    app.specter = specter
+    app.config["LOGIN_DISABLED"] = specter.config["auth"].get("method") == "none"
+
+    app.register_blueprint(hwi_server, url_prefix="/hwi")
+    csrf.exempt(hwi_server)
+
+    @app.route("/", methods=["GET"])
+    def index():
+        return redirect(url_for("hwi_server.hwi_bridge_settings"))
+
+    init_tor_context_processor(app)
+    init_babel(app)
+    return app
+
+
+def init_specter(app: SpecterFlask, specter=None):
+    """Runs the migrations, sets the secret-key and the RPC-timeouts and returns the
+    Specter instance (created if not injected) which is not initialized yet
+    """
     # First: Migrations
     mm = SpecterMigrator(app.config["SPECTER_DATA_FOLDER"])
     mm.execute_migrations()
 
-    # Login via Flask-Login
-    app.logger.info("Initializing LoginManager")
     app.secret_key = app.config["SECRET_KEY"]
     BitcoinRPC.default_timeout = app.config["BITCOIN_RPC_TIMEOUT"]
     LiquidRPC.default_timeout = app.config["LIQUID_RPC_TIMEOUT"]
@@ -163,27 +294,21 @@ def init_app(app: SpecterFlask, hwibridge=False, specter=None):
             internal_bitcoind_version=app.config["INTERNAL_BITCOIND_VERSION"],
             initialize=False,
         )
+    return specter
 
-    # ServiceManager will instantiate and register blueprints for extensions
-    # It's an attribute to the specter but specter is not aware of it.
-    # However some managers are aware of it and so we need to split
-    # instantiation from initializing and in between attach the service_manager
-    specter.service_manager = ExtensionManager(
-        specter=specter, devstatus_threshold=app.config["SERVICES_DEVSTATUS_THRESHOLD"]
-    )
 
-    def service_manager_cleanup_on_exit(signum, frame):
-        return specter.service_manager.execute_ext_callbacks(
-            callbacks.cleanup_on_exit, signum, frame
+def init_url_prefix(app: SpecterFlask):
+    """Mounts the app below APP_URL_PREFIX (if configured)"""
+    if app.config["APP_URL_PREFIX"] != "":
+        # https://dlukes.github.io/flask-wsgi-url-prefix.html
+        app.wsgi_app = DispatcherMiddleware(
+            Response("Not Found", status=404),
+            {app.config["APP_URL_PREFIX"]: app.wsgi_app},
         )
 
-    specter.call_functions_at_cleanup_on_exit.append(service_manager_cleanup_on_exit)
-
-    specter.initialize()
-
-    # HWI
-    specter.hwi = HWIBridge(app.config["ENFORCE_HWI_INITIALISATION_AT_STARTUP"])
 
+def init_login(app: SpecterFlask, specter):
+    """Sets up Flask-Login with the users of the specter instance"""
     login_manager = LoginManager()
     login_manager.session_protection = app.config.get("SESSION_PROTECTION", "strong")
     login_manager.init_app(app)  # Enable Login
@@ -204,57 +329,10 @@ def init_app(app: SpecterFlask, hwibridge=False, specter=None):
             user.decrypt_user_secret(password)
 
     app.login = login
-    # Attach specter instance so child views (e.g. hwi) can access it
-    app.specter = specter
-    # Executing callback specter_added_to_flask_app
-    app.logger.info("Executing callback specter_added_to_flask_app ...")
-    specter.service_manager.execute_ext_callbacks(specter_added_to_flask_app)
-    if specter.config["auth"].get("method") == "none":
-        app.logger.info("Login disabled")
-        app.config["LOGIN_DISABLED"] = True
-    else:
-        app.logger.info("Login enabled")
-        app.config["LOGIN_DISABLED"] = False
-    app.logger.info("Initializing Controller ...")
-    app.register_blueprint(hwi_server, url_prefix="/hwi")
-    csrf.exempt(hwi_server)
-    if not hwibridge:
-        with app.app_context():
-            from cryptoadvance.specter.server_endpoints import controller
-            from cryptoadvance.specter.services import controller as serviceController
-
-            # this number of view_functions needs to be updated by hand when some are added or removed.
-            number_of_expected_view_functions = 105
-            if app.config.get("TESTING"):
-                logger.info(
-                    f"We have {len(app.view_functions)} view Functions. "
-                    f"There should be {number_of_expected_view_functions}."
-                )
-            if (
-                app.config.get("TESTING")
-                and len(app.view_functions) < number_of_expected_view_functions
-            ):
-                # Need to force a reload as otherwise the import is skipped
-                # in pytest, the app is created anew for each test
-                # But we shouldn't do that if not necessary as this would result in
-                # --> View function mapping is overwriting an existing endpoint function
-                # see archblog for more about this nasty workaround
-                import importlib
-
-                logger.info("Reloading controllers")
-                importlib.reload(controller)
-                importlib.reload(serviceController)
-    else:
-
-        @app.route("/", methods=["GET"])
-        def index():
-            return redirect(url_for("hwi_server.hwi_bridge_settings"))
 
-    if app.config["SPECTER_API_ACTIVE"]:
-        app.logger.info("Initializing REST ...")
-        from cryptoadvance.specter.api import api_bp
 
-        app.register_blueprint(api_bp)
+def init_tor_context_processor(app: SpecterFlask):
+    """Makes tor_service_id and tor_enabled available in the templates"""
 
     @app.context_processor
     def inject_tor():
@@ -262,7 +340,9 @@ def init_app(app: SpecterFlask, hwibridge=False, specter=None):
             return dict(tor_service_id="", tor_enabled=False)
         return dict(tor_service_id=app.tor_service_id, tor_enabled=app.tor_enabled)
 
-    # --------------------- Babel integration ---------------------
+
+def init_babel(app: SpecterFlask):
+    """Babel integration and the endpoint to switch the language"""
     if getattr(sys, "frozen", False):
         app.config["BABEL_TRANSLATION_DIRECTORIES"] = os.path.join(
             sys._MEIPASS, "translations"
@@ -286,29 +366,6 @@ def init_app(app: SpecterFlask, hwibridge=False, specter=None):
         else:
             return jsonify(success=False)
 
-    # --------------------- Babel integration ---------------------
-
-    # Background Scheduler
-    def every5seconds():
-        ctx = app.app_context()
-        ctx.push()
-        app.specter.service_manager.execute_ext_callbacks(callbacks.every5seconds)
-        ctx.pop()
-
-    # initialize scheduler
-    from apscheduler.schedulers.background import BackgroundScheduler
-
-    scheduler = APScheduler()
-
-    scheduler.init_app(app)
-    scheduler.start()
-    specter.service_manager.add_required_services_to_users(specter.user_manager.users)
-    logger.info("----> starting service callback_after_serverpy_init_app ")
-    specter.service_manager.execute_ext_callbacks(
-        after_serverpy_init_app, scheduler=scheduler
-    )
-    return app
-
 
 def setup_logging(debug=False, tracerpc=False, tracerequests=False):
     """This code sets up logging for a Python application. It sets the logging level to DEBUG if the tracerpc
@@ -355,6 +412,22 @@ def setup_logging(debug=False, tracerpc=False, tracerequests=False):
     logging.getLogger().addHandler(ch)
 
 
+def setup_filelog(logfile, logformat):
+    """Additionally writes everything which reaches the root logger to logfile.
+    The writing happens in a background thread, so logging doesn't block on disk-IO.
+    The QueueListener gets stopped (and therefore flushed) at interpreter exit, whichever
+    way the process ends. It's returned mainly for testing.
+    """
+    fh = logging.FileHandler(logfile)
+    fh.setFormatter(logging.Formatter(logformat))
+    log_queue = queue.SimpleQueue()
+    logging.getLogger().addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, fh, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
 def setup_debug_logging():
     """Sets the cryptoadvance.* logger to debug"""
     ca_logger = logging.getLogger("cryptoadvance")
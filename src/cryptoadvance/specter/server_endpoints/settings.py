@@ -308,7 +308,12 @@ def tor():
                 app.specter.update_only_tor(only_tor, current_user)
 
             if hidden_service != app.specter.config["tor_status"]:
-                if not app.config["DEBUG"]:
+                if not app.tor_ready.is_set():
+                    flash(
+                        "The Tor hidden service is still starting up, please try again in a moment",
+                        "error",
+                    )
+                elif not app.config["DEBUG"]:
                     if app.specter.config["auth"].get("method", "none") == "none":
                         flash(
                             "Enabling Tor hidden service will expose your Specter for remote access.<br>It is therefore required that you set up authentication tab for Specter first to prevent unauthorized access.<br><br>Please go to Settings -> Authentication and set up an authentication method and retry.",
@@ -1,10 +1,16 @@
+import atexit
 import logging
 import os
+import ssl
 import sys
+import threading
+import time
 import traceback
 
 from click.testing import CliRunner
 from cryptoadvance.specter.cli import server
+from cryptoadvance.specter.cli.cli_server import configure_ssl, iter_files
+from cryptoadvance.specter.server import setup_filelog
 from mock import MagicMock, call, patch
 
 mock_config_dict = {
@@ -52,23 +58,18 @@ def test_server_host_and_port(init_app, create_app, caplog):
 
 @patch("cryptoadvance.specter.cli.cli_server.create_app")
 @patch("cryptoadvance.specter.cli.cli_server.init_app")
-def test_server_host_and_port(init_app, create_app, caplog):
+def test_server_host_and_port(init_app, create_app, caplog, tmp_path):
     """This test will fail if you have turned on live-logging in pyproject.toml (log_cli = 1 )"""
     caplog.set_level(logging.DEBUG)
     mock_app = MagicMock()
     mock_app.config = MagicMock()
-    d = mock_config_dict
+    d = cert_config(mock_config_dict, tmp_path)
     mock_app.config.__getitem__.side_effect = d.__getitem__
     create_app.return_value = mock_app
     runner = CliRunner()
-    try:
-        with runner.isolated_filesystem():
-            result = runner.invoke(
-                server, ["--cert", "bla", "--key", "blub", "--no-filelog"]
-            )
-    finally:
-        # not sure why i need to do that in an isolated_filesystem ?!
-        tidy_up()
+    result = runner.invoke(
+        server, ["--cert", d["CERT"], "--key", d["KEY"], "--no-filelog"]
+    )
     print(result.output)
     if result.exception != None:
         # Makes searching for issues much more convenient
@@ -77,17 +78,12 @@ def test_server_host_and_port(init_app, create_app, caplog):
     assert result.exit_code == 0
     print(mock_app.config.mock_calls)
     mock_app.config.__setitem__.call_count = 2
-    mock_app.config.__setitem__.assert_called_with("KEY", "blub")
-    mock_app.config.__setitem__.assert_any_call("CERT", "bla")
-    # This doesn't work as the tmp-directory is always different
-    # mock_app.run.assert_called_with(debug='WURSTBROT', host='0.0.0.1', port='123', extra_files=['templates'],ssl_context=('/tmp/tmpb_2552yg/bla', '/tmp/tmpb_2552yg/blub')))
-    # So let's check differently:
-
+    mock_app.config.__setitem__.assert_called_with("KEY", d["KEY"])
+    mock_app.config.__setitem__.assert_any_call("CERT", d["CERT"])
     print(mock_app.run.call_args.kwargs)
     # results in something like:
-    # {'debug': 'WURSTBROT', 'host': '127.0.0.1', 'port': '123', 'extra_files': ['templates'], 'ssl_context': ('/tmp/tmpnzivft_y/bla', '/tmp/tmpnzivft_y/blub')}
-    assert mock_app.run.call_args.kwargs["ssl_context"][0].endswith("bla")
-    assert mock_app.run.call_args.kwargs["ssl_context"][1].endswith("blub")
+    # {'debug': 'WURSTBROT', 'host': '127.0.0.1', 'port': '123', 'extra_files': ['templates'], 'ssl_context': ('/tmp/pytest-of-root/pytest-1/test_server_host_and_port0/bla', '/tmp/pytest-of-root/pytest-1/test_server_host_and_port0/blub')}
+    assert mock_app.run.call_args.kwargs["ssl_context"] == (d["CERT"], d["KEY"])
 
 
 @patch("cryptoadvance.specter.cli.cli_server.create_app")
@@ -95,6 +91,11 @@ def test_server_host_and_port(init_app, create_app, caplog):
 def test_server_debug(init_app, create_app, caplog):
     """This test will fail if you have turned on live-logging in pyproject.toml (log_cli = 1 )"""
     caplog.set_level(logging.DEBUG)
+    mock_app = MagicMock()
+    mock_app.config = MagicMock()
+    d = dict(mock_config_dict, CERT=None, KEY=None)
+    mock_app.config.__getitem__.side_effect = d.__getitem__
+    create_app.return_value = mock_app
     runner = CliRunner()
     result = runner.invoke(server, ["--debug", "--no-filelog"])
     print(result.output)
@@ -104,16 +105,89 @@ def test_server_debug(init_app, create_app, caplog):
     print(result.exception)
     assert result.exit_code == 0
     assert "We're now on level DEBUG on logger cryptoadvance" in caplog.text
+    run_kwargs = create_app.return_value.run.call_args.kwargs
+    assert run_kwargs["reloader_type"] == "watchdog"
+    assert run_kwargs["extra_files"] == ["templates"]
+
+
+@patch("cryptoadvance.specter.util.tor.start_hidden_service")
+@patch("cryptoadvance.specter.cli.cli_server.create_app")
+@patch("cryptoadvance.specter.cli.cli_server.init_app")
+def test_server_tor_in_background(init_app, create_app, start_hidden_service):
+    mock_app = MagicMock()
+    mock_app.config = MagicMock()
+    d = dict(mock_config_dict, CERT=None, KEY=None)
+    mock_app.config.__getitem__.side_effect = d.__getitem__
+    # as in create_app
+    mock_app.tor_ready = threading.Event()
+    mock_app.tor_ready.set()
+    create_app.return_value = mock_app
+    # the hidden service startup hangs until we release it
+    release = threading.Event()
+    start_hidden_service.side_effect = lambda app: release.wait(timeout=5)
+    runner = CliRunner()
+    try:
+        result = runner.invoke(server, ["--tor", "--no-filelog"])
+        assert result.exit_code == 0
+        # app.run is not blocked by the hidden service startup
+        mock_app.run.assert_called_once()
+        assert not mock_app.tor_ready.is_set()
+    finally:
+        release.set()
+    assert mock_app.tor_ready.wait(timeout=5)
+    start_hidden_service.assert_called_once_with(mock_app)
+
+
+@patch("cryptoadvance.specter.cli.cli_server.create_app")
+@patch("cryptoadvance.specter.cli.cli_server.init_app")
+def test_server_tor_controller_close_hangs(init_app, create_app, caplog):
+    caplog.set_level(logging.DEBUG)
+    mock_app = MagicMock()
+    mock_app.config = MagicMock()
+    d = dict(mock_config_dict, CERT=None, KEY=None)
+    mock_app.config.__getitem__.side_effect = d.__getitem__
+    create_app.return_value = mock_app
+    release = threading.Event()
+    mock_app.specter.tor_controller.close.side_effect = lambda: release.wait(timeout=10)
+    runner = CliRunner()
+    try:
+        start = time.monotonic()
+        result = runner.invoke(server, ["--no-filelog"])
+        # the shutdown doesn't wait for the hanging close longer than 2 seconds
+        assert time.monotonic() - start < 5
+    finally:
+        release.set()
+    assert result.exit_code == 0
+    mock_app.specter.tor_controller.close.assert_called_once()
+    assert "Closing the tor-controller timed out" in caplog.text
+
+
+@patch("cryptoadvance.specter.cli.cli_server.create_app")
+@patch("cryptoadvance.specter.cli.cli_server.init_app")
+def test_server_tor_controller_close_fails(init_app, create_app, caplog):
+    caplog.set_level(logging.DEBUG)
+    mock_app = MagicMock()
+    mock_app.config = MagicMock()
+    d = dict(mock_config_dict, CERT=None, KEY=None)
+    mock_app.config.__getitem__.side_effect = d.__getitem__
+    create_app.return_value = mock_app
+    mock_app.specter.tor_controller.close.side_effect = OSError("Broken pipe")
+    runner = CliRunner()
+    result = runner.invoke(server, ["--no-filelog"])
+    assert result.exit_code == 0
+    # logged instead of ending up in threading.excepthook
+    assert "Could not close the tor-controller: Broken pipe" in caplog.text
+    assert "Closing the tor-controller timed out" not in caplog.text
 
 
 @patch("cryptoadvance.specter.cli.cli_server.create_app")
 @patch("cryptoadvance.specter.cli.cli_server.init_app")
-def test_server_datafolder(init_app, create_app, caplog):
+def test_server_datafolder(init_app, create_app, caplog, tmp_path):
     """This test will fail if you have turned on live-logging in pyproject.toml (log_cli = 1 )"""
     caplog.set_level(logging.DEBUG)
     mock_app = MagicMock()
     mock_app.config = MagicMock()
-    d = mock_config_dict
+    d = cert_config(mock_config_dict, tmp_path)
     mock_app.config.__getitem__.side_effect = d.__getitem__
     create_app.return_value = mock_app
     runner = CliRunner()
@@ -134,7 +208,7 @@ def test_server_datafolder(init_app, create_app, caplog):
 
 @patch("cryptoadvance.specter.cli.cli_server.create_app")
 @patch("cryptoadvance.specter.cli.cli_server.init_app")
-def test_server_config(init_app, create_app, caplog):
+def test_server_config(init_app, create_app, caplog, tmp_path):
     """This test will fail if you have turned on live-logging in pyproject.toml (log_cli = 1 )"""
     caplog.set_level(logging.DEBUG)
     mock_app = MagicMock()
@@ -155,15 +229,11 @@ def test_server_config(init_app, create_app, caplog):
         "CERT": "bla",
         "KEY": "blub",
     }
+    d = cert_config(d, tmp_path)
     mock_app.config.__getitem__.side_effect = d.__getitem__
     create_app.return_value = mock_app
     runner = CliRunner()
-    try:
-        with runner.isolated_filesystem():
-            result = runner.invoke(server, ["--config", "MuhConfig", "--no-filelog"])
-    finally:
-        # not sure why i need to do that in an isolated_filesystem ?!
-        tidy_up()
+    result = runner.invoke(server, ["--config", "MuhConfig", "--no-filelog"])
     print(result.output)
     if result.exception != None:
         # Makes searching for issues much more convenient
@@ -172,11 +242,91 @@ def test_server_config(init_app, create_app, caplog):
     assert result.exit_code == 0
     print(mock_app.config.mock_calls)
     create_app.assert_called_once_with(config="cryptoadvance.specter.config.MuhConfig")
-    tidy_up()
 
 
-def tidy_up():
-    if os.path.exists("bla"):
-        os.remove("bla")
-    if os.path.exists("blub"):
-        os.remove("blub")
+def cert_config(config_dict, tmp_path):
+    """Lets a cert created by the test land in tmp_path instead of the working tree"""
+    return dict(
+        config_dict,
+        CERT=str(tmp_path / "bla"),
+        KEY=str(tmp_path / "blub"),
+        SPECTER_DATA_FOLDER=str(tmp_path),
+    )
+
+
+def test_iter_files(tmp_path):
+    (tmp_path / "sub" / "subsub").mkdir(parents=True)
+    (tmp_path / "a.html").write_text("a")
+    (tmp_path / "sub" / "b.html").write_text("b")
+    (tmp_path / "sub" / "subsub" / "c.jinja").write_text("c")
+    assert sorted(iter_files(str(tmp_path))) == sorted(
+        [
+            str(tmp_path / "a.html"),
+            str(tmp_path / "sub" / "b.html"),
+            str(tmp_path / "sub" / "subsub" / "c.jinja"),
+        ]
+    )
+    assert list(iter_files(str(tmp_path / "non_existing"))) == []
+
+
+def test_configure_ssl_creates_cert_once(tmp_path):
+    app_config = dict(mock_config_dict)
+    app_config["SPECTER_DATA_FOLDER"] = str(tmp_path)
+    app_config["CERT"] = None
+    app_config["KEY"] = None
+    ssl_context = configure_ssl(app_config, True)
+    assert ssl_context == (str(tmp_path / "cert.pem"), str(tmp_path / "key.pem"))
+    assert app_config["CERT"] == str(tmp_path / "cert.pem")
+    assert app_config["KEY"] == str(tmp_path / "key.pem")
+    # the pair can be used for serving TLS
+    ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER).load_cert_chain(*ssl_context)
+    # no leftovers of the temporary files, the (harmless) lockfile stays
+    assert sorted(os.listdir(tmp_path)) == ["cert.pem", "key.pem", "ssl-cert.lock"]
+    cert = (tmp_path / "cert.pem").read_text()
+    assert cert.startswith("-----BEGIN CERTIFICATE-----")
+    # An existing cert is not created again
+    assert configure_ssl(app_config, True) == ssl_context
+    assert (tmp_path / "cert.pem").read_text() == cert
+
+
+def test_configure_ssl_without_ssl():
+    app_config = dict(mock_config_dict, CERT=None, KEY=None)
+    assert configure_ssl(app_config, False) is None
+    # e.g. CERT= in the environment
+    app_config["CERT"] = ""
+    assert configure_ssl(app_config, False) is None
+
+
+def test_setup_filelog(tmp_path):
+    logfile = tmp_path / "specter.log"
+    root_handlers = logging.getLogger().handlers[:]
+    listener = setup_filelog(str(logfile), "%(levelname)s: %(message)s")
+    try:
+        logging.getLogger("cryptoadvance.test").warning("Hello %s", "file")
+    finally:
+        listener.stop()
+        atexit.unregister(listener.stop)
+        logging.getLogger().handlers = root_handlers
+    assert logfile.read_text() == "WARNING: Hello file\n"
+
+
+def test_configure_ssl_random_serial_number(tmp_path):
+    from cryptography import x509
+
+    serial_numbers = []
+    for i in range(2):
+        app_config = dict(mock_config_dict, SPECTER_SSL_CERT_SERIAL_NUMBER=None)
+        app_config["SPECTER_DATA_FOLDER"] = str(tmp_path)
+        app_config["CERT"] = str(tmp_path / f"cert{i}.pem")
+        app_config["KEY"] = str(tmp_path / f"key{i}.pem")
+        configure_ssl(app_config, True)
+        cert = x509.load_pem_x509_certificate((tmp_path / f"cert{i}.pem").read_bytes())
+        serial_numbers.append(cert.serial_number)
+    assert serial_numbers[0] != serial_numbers[1]
+    # a configured serial number is still respected
+    app_config = dict(mock_config_dict, SPECTER_DATA_FOLDER=str(tmp_path))
+    app_config["CERT"] = str(tmp_path / "cert.pem")
+    app_config["KEY"] = str(tmp_path / "key.pem")
+    configure_ssl(app_config, True)
+    cert = x509.load_pem_x509_certificate((tmp_path / "cert.pem").read_bytes())
+    assert cert.serial_number == 123
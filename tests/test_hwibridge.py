@@ -1,4 +1,8 @@
 import json, requests
+from cryptoadvance.specter.liquid.rpc import LiquidRPC
+from cryptoadvance.specter.rpc import BitcoinRPC
+from cryptoadvance.specter.server import create_app, init_app, init_app_hwibridge
+from cryptoadvance.specter.specter import Specter
 from cryptoadvance.specter.devices.ledger import Ledger
 from cryptoadvance.specter.devices.trezor import Trezor
 
@@ -178,3 +182,32 @@ def test_call_prompt_pin_invalid_device(client):
         },
         "id": 1,
     } == json.loads(req.data)
+
+
+def test_init_app_hwibridge(empty_data_folder):
+    specter = Specter(data_folder=empty_data_folder, checker_threads=False)
+    app = create_app(config="cryptoadvance.specter.config.TestConfig")
+    app.config["TESTING"] = True
+    BitcoinRPC.default_timeout = None
+    with app.app_context():
+        init_app_hwibridge(app, specter=specter)
+    # otherwise an unresponsive node would block the startup forever
+    assert BitcoinRPC.default_timeout == app.config["BITCOIN_RPC_TIMEOUT"]
+    assert LiquidRPC.default_timeout == app.config["LIQUID_RPC_TIMEOUT"]
+    # Only the hwi_server, no controllers or extensions
+    assert list(app.blueprints.keys()) == ["hwi_server"]
+    client = app.test_client()
+    req = client.get("/", follow_redirects=True)
+    assert req.status_code == 200
+    assert b"HWI Bridge Settings" in req.data
+
+
+def test_init_app_with_hwibridge(empty_data_folder):
+    specter = Specter(data_folder=empty_data_folder, checker_threads=False)
+    app = create_app(config="cryptoadvance.specter.config.TestConfig")
+    app.config["TESTING"] = True
+    with app.app_context():
+        init_app(app, hwibridge=True, specter=specter)
+    # the same as init_app_hwibridge
+    assert list(app.blueprints.keys()) == ["hwi_server"]
+    assert app.specter == specter
@@ -1,9 +1,13 @@
 import os
 from unittest.mock import MagicMock, Mock
+
+import pytest
+from flask import Flask
 from cryptoadvance.specter.persistence import (
     write_devices,
     write_device,
     write_wallet,
+    storage_callback,
     PersistentObject,
 )
 from cryptoadvance.specter.key import Key
@@ -79,3 +83,19 @@ def test_PersistentObject():
         {"python_class": "cryptoadvance.specter.node.Node"}, MagicMock()
     )
     assert some_node.__class__.__name__ == "Node"
+
+
+def test_storage_callback_without_service_manager():
+    flask_app = Flask(__name__)
+    # like in hwibridge-mode: a specter without extensions
+    flask_app.specter = Mock(spec=[])
+    with flask_app.app_context():
+        storage_callback(path="some/path")
+    # an AttributeError raised by an extension is not swallowed
+    flask_app.specter = MagicMock()
+    flask_app.specter.service_manager.execute_ext_callbacks.side_effect = (
+        AttributeError("'Foo' object has no attribute 'service_manager'")
+    )
+    with flask_app.app_context():
+        with pytest.raises(AttributeError):
+            storage_callback(path="some/path")
@@ -0,0 +1,41 @@
+from mock import patch
+
+
+@patch("cryptoadvance.specter.server_endpoints.settings.flash")
+@patch("cryptoadvance.specter.server_endpoints.settings.stop_hidden_services")
+@patch("cryptoadvance.specter.server_endpoints.settings.start_hidden_service")
+def test_tor_toggle_hidden_service_while_starting_up(
+    start_hidden_service, stop_hidden_services, mock_flash, app_no_node
+):
+    app = app_no_node
+    app.config["WTF_CSRF_ENABLED"] = False
+    app.config["DEBUG"] = False
+    assert app.specter.config["tor_status"] == False
+    # The hidden service is still being started in the background (see cli_server)
+    app.tor_ready.clear()
+    client = app.test_client()
+    data = {
+        "action": "save",
+        "tor_type": "disabled",
+        "proxy_url": "socks5h://localhost:9050",
+        "tor_control_port": "",
+        "hidden_service": "on",
+    }
+    # Enabling the hidden service requires some authentication
+    with patch.dict(app.specter.config["auth"], {"method": "passwordonly"}):
+        with patch.object(app.specter, "toggle_tor_status") as toggle_tor_status:
+            res = client.post("/settings/tor", data=data)
+            assert res.status_code == 200
+            start_hidden_service.assert_not_called()
+            stop_hidden_services.assert_not_called()
+            toggle_tor_status.assert_not_called()
+            mock_flash.assert_any_call(
+                "The Tor hidden service is still starting up, please try again in a moment",
+                "error",
+            )
+            # Once the startup is done, toggling is possible again
+            app.tor_ready.set()
+            res = client.post("/settings/tor", data=data)
+            assert res.status_code == 200
+            start_hidden_service.assert_called_once()
+            toggle_tor_status.assert_called_once()